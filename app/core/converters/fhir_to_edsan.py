@@ -1,6 +1,7 @@
 import json
 import glob
 import os
+import sys
 import polars as pl
 from datetime import datetime
 
@@ -14,19 +15,9 @@ FHIR_PATH = r"C:\Projets\Ping\synthea\output\fhir\*.json"
 # Dossier de destination pour les tables EDS
 EDS_PATH = "eds/"
 
-os.makedirs(EDS_PATH, exist_ok=True)
-
-# Listes pour stocker les donnees avant conversion en DataFrame
-PATIENT_rows = []
-MVT_rows = []
-BIOL_rows = []
-PHARMA_rows = []
-PMSI_rows = []
-DOCEDS_rows = []
-
-# Dictionnaires pour les jointures rapides (lookup)
-MEDICATION_DICT = {}
-ENCOUNTER_DICT = {}
+# Duree maximale d'un sejour sans period.end (DATSORT manquant) :
+# au-dela, un evenement orphelin n'est pas rattache a ce sejour.
+OPEN_STAY_WINDOW = "1d"
 
 # =====================================================
 # 2. FONCTIONS UTILITAIRES CRITIQUES
@@ -78,132 +69,185 @@ def extract_date(resource, *keys):
     return resource.get("performedPeriod", {}).get("start")
 
 # =====================================================
-# 3. LECTURE ET EXTRACTION DES DONNEES
+# 3. RATTACHEMENT DES EVENEMENTS AUX SEJOURS
 # =====================================================
 
-files = glob.glob(FHIR_PATH)
-print(f"Traitement de {len(files)} fichiers...")
+def parse_timestamp(col):
+    """
+    Lit une colonne de dates ISO-8601 (texte) et retourne deux expressions :
+    - l'instant en UTC, si la date porte une heure. Le decalage horaire
+      (+01:00, Z...) est applique ; sans decalage, l'heure est supposee UTC.
+    - le jour a minuit, si la date n'a pas d'heure (YYYY-MM-DD).
+    Sejours et evenements passent tous par cette fonction, pour etre
+    compares sur la meme horloge.
+    """
+    s = pl.col(col).cast(pl.Utf8).str.replace(r"Z$", "+00:00")
+    timed = pl.coalesce(
+        s.str.strptime(pl.Datetime, "%Y-%m-%dT%H:%M:%S%.f%z", strict=False)
+        .dt.replace_time_zone(None),
+        s.str.strptime(pl.Datetime, "%Y-%m-%dT%H:%M:%S%.f", strict=False)
+    )
+    day = s.str.slice(0, 10).str.strptime(pl.Datetime, "%Y-%m-%d", strict=False)
+    return timed, day
 
-for file in files:
-    with open(file, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    
-    if "entry" not in data: continue
-
-    # PASSE 1 : Construction du dictionnaire des medicaments
-    for entry in data["entry"]:
-        r = entry.get("resource", {})
-        if r.get("resourceType") == "Medication":
-            code = safe_get(r, "code", "coding", 0, "code")
-            name = safe_get(r, "code", "coding", 0, "display")
-            MEDICATION_DICT[clean_id(r.get("id"))] = {"code": code, "name": name}
-
-    # PASSE 2 : Extraction des ressources cliniques
-    for entry in data["entry"]:
-        r = entry.get("resource", {})
-        rtype = r.get("resourceType")
-        rid = clean_id(r.get("id"))
-        
-        # Recuperation de l'ID patient nettoye
-        pat_ref = clean_id(safe_get(r, "subject", "reference") or safe_get(r, "patient", "reference"))
-
-        # --- Table PATIENT ---
-        if rtype == "Patient":
-            PATIENT_rows.append({
-                "PATID": rid, 
-                "PATSEX": r.get("gender"),
-                "PATBD": r.get("birthDate")
-            })
-
-        # --- Table MVT (Rencontres/Sejours) ---
-        elif rtype == "Encounter":
-            sejum = safe_get(r, "location", 0, "physicalType", "text")
-            sejuf = clean_id(safe_get(r, "location", 0, "location", "reference"))
-            
-            MVT_rows.append({
-                "PATID": pat_ref, 
-                "EVTID": rid, 
-                "ELTID": rid,
-                "DATENT": safe_get(r, "period", "start"), 
-                "SEJUM": sejum,
-                "SEJUF": sejuf
-            })
-            ENCOUNTER_DICT[rid] = {"SEJUM": sejum, "SEJUF": sejuf}
-
-        # --- Table BIOL (Resultats Labo) ---
-        elif rtype == "Observation" and "valueQuantity" in r:
-            evt_ref = clean_id(safe_get(r, "encounter", "reference"))
-            BIOL_rows.append({
-                "PATID": pat_ref, 
-                "EVTID": evt_ref, 
-                "ELTID": rid,
-                "PRLVTDATE": extract_date(r, "effectiveDateTime", "issued"),
-                "PNAME": safe_get(r, "code", "text"),
-                "RESULT": r["valueQuantity"].get("value"),
-                "UNIT": r["valueQuantity"].get("unit")
-            })
-
-        # --- Table PHARMA (Prescriptions) ---
-        elif rtype == "MedicationRequest":
-            med_ref = clean_id(safe_get(r, "medicationReference", "reference"))
-            med_info = MEDICATION_DICT.get(med_ref, {})
-            name = med_info.get("name") or safe_get(r, "medicationCodeableConcept", "text")
-            
-            PHARMA_rows.append({
-                "PATID": pat_ref, 
-                "EVTID": clean_id(safe_get(r, "encounter", "reference")),
-                "ELTID": rid, 
-                "ALLSPELABEL": name, 
-                "DATPRES": r.get("authoredOn"),
-                "PRES": safe_get(r, "dosageInstruction", 0, "text")
-            })
-
-        # --- Table PMSI (Diagnostics et Actes) ---
-        elif rtype in ["Condition", "Procedure"]:
-            PMSI_rows.append({
-                "PATID": pat_ref, 
-                "EVTID": clean_id(safe_get(r, "encounter", "reference")),
-                "ELTID": rid, 
-                "TYPE": rtype,
-                "CODE": safe_get(r, "code", "coding", 0, "code"),
-                "LIBELLE": safe_get(r, "code", "text") or safe_get(r, "code", "coding", 0, "display"),
-                "DATENT": extract_date(r, "onsetDateTime", "performedDateTime", "recordedDate")
-            })
-
-        # --- Table DOCEDS (Documents textuels) ---
-        elif rtype in ["DiagnosticReport", "DocumentReference"]:
-            evt_ref = clean_id(safe_get(r, "encounter", "reference"))
-            txt = "Non extrait"
-            
-            if rtype == "DiagnosticReport": 
-                txt = safe_get(r, "presentedForm", 0, "data")
-            elif rtype == "DocumentReference": 
-                txt = safe_get(r, "content", 0, "attachment", "data")
-
-            DOCEDS_rows.append({
-                "PATID": pat_ref, 
-                "EVTID": evt_ref, 
-                "ELTID": rid,
-                "RECTXT": txt, 
-                "RECDATE": extract_date(r, "effectiveDateTime", "date", "created"),
-                "SEJUM": ENCOUNTER_DICT.get(evt_ref, {}).get("SEJUM")
-            })
+def parse_date(col):
+    """
+    Convertit une colonne de dates ISO-8601 (texte) en Datetime UTC.
+    Une date sans heure est placee a minuit.
+    """
+    return pl.coalesce(*parse_timestamp(col))
+
+def prepare_stays(df_mvt):
+    """
+    Prepare la table MVT pour le rattachement.
+    La fin effective du sejour (_FIN) est DATSORT, ou DATENT + OPEN_STAY_WINDOW
+    si period.end est absent (_OUVERT).
+    """
+    return df_mvt.select(
+        pl.col("PATID").cast(pl.Utf8),
+        pl.col("EVTID").cast(pl.Utf8).alias("_STAYID"),
+        parse_date("DATENT").alias("_DATENT"),
+        parse_date("DATSORT").alias("_DATSORT"),
+        pl.col("SEJUM").cast(pl.Utf8),
+        pl.col("SEJUF").cast(pl.Utf8)
+    ).filter(pl.col("_STAYID").is_not_null()).unique(subset="_STAYID", keep="first").with_columns(
+        pl.col("_DATSORT").is_null().alias("_OUVERT"),
+        pl.coalesce(
+            pl.col("_DATSORT"),
+            pl.col("_DATENT").dt.offset_by(OPEN_STAY_WINDOW)
+        ).alias("_FIN")
+    ).drop("_DATSORT")
+
+def link_to_stays(df, df_stays, date_col):
+    """
+    Rattache chaque evenement a un sejour de la table MVT (voir prepare_stays).
+    - Si la ressource porte un encounter.reference, l'EVTID est conserve.
+    - Sinon (evenement orphelin), on cherche un sejour du meme patient tel que
+      DATENT <= date <= fin du sejour. Une date sans heure est comparee a la
+      journee entiere. Le plus souvent, c'est le dernier sejour commence avant
+      l'evenement (join_asof par PATID) ; sinon (sejours imbriques ou qui se
+      chevauchent), une jointure d'intervalle sur PATID est faite pour les
+      seuls evenements qu'un sejour plus ancien peut encore couvrir, et le
+      sejour commence le plus tard est retenu.
+    SEJUM et SEJUF sont ensuite repris de la table MVT par jointure sur EVTID.
+    Retourne la table rattachee et un dictionnaire de taux de rattachement.
+    """
+    timed, day = parse_timestamp(date_col)
+
+    # Chaque evenement est un intervalle [_DEBUT, _FIN_EVT] : un instant
+    # s'il est horodate, la journee entiere sinon
+    df = df.with_row_index("_ROW").with_columns(
+        pl.col("PATID").cast(pl.Utf8),
+        pl.col("EVTID").cast(pl.Utf8),
+        pl.coalesce(timed, day).alias("_DEBUT"),
+        pl.when(timed.is_null())
+        .then(day.dt.offset_by("1d") - pl.duration(microseconds=1))
+        .otherwise(timed)
+        .alias("_FIN_EVT")
+    )
+    n_orphans = df.filter(pl.col("EVTID").is_null()).height
+
+    # _FIN_MAX : fin la plus tardive des sejours du patient commences au plus
+    # tard a ce DATENT. Si elle precede l'evenement, aucun sejour ne le couvre.
+    intervals = (
+        df_stays.filter(pl.col("PATID").is_not_null() & pl.col("_DATENT").is_not_null())
+        .select("PATID", "_STAYID", "_DATENT", "_FIN", "_OUVERT")
+        .sort(["PATID", "_DATENT"])
+        .with_columns(pl.col("_FIN").cum_max().over("PATID").alias("_FIN_MAX"))
+        .with_columns(pl.col("_FIN_MAX").max().over(["PATID", "_DATENT"]))
+    )
+    candidates = df.filter(
+        pl.col("EVTID").is_null() & pl.col("PATID").is_not_null() & pl.col("_DEBUT").is_not_null()
+    ).select("_ROW", "PATID", "_DEBUT", "_FIN_EVT")
+    inside = (pl.col("_DATENT") <= pl.col("_FIN_EVT")) & (pl.col("_DEBUT") <= pl.col("_FIN"))
+    link_cols = ["_ROW", "_STAYID", "_OUVERT"]
+
+    # 1. Jointure asof vectorisee : dernier sejour commence avant l'evenement
+    asof = candidates.sort("_FIN_EVT").join_asof(
+        intervals.sort("_DATENT"),
+        left_on="_FIN_EVT", right_on="_DATENT",
+        by="PATID", strategy="backward"
+    )
+    by_asof = asof.filter(inside).select(link_cols)
+
+    # 2. Jointure d'intervalle, reservee aux evenements hors de ce sejour
+    # mais encore couverts par un sejour plus ancien et plus long (_FIN_MAX)
+    to_range = asof.filter(~inside & (pl.col("_FIN_MAX") >= pl.col("_DEBUT"))).select(
+        "_ROW", "PATID", "_DEBUT", "_FIN_EVT"
+    )
+    by_range = (
+        to_range.join(intervals, on="PATID", how="inner")
+        .filter(inside)
+        .sort("_DATENT", descending=True)
+        .unique(subset="_ROW", keep="first")
+        .select(link_cols)
+    )
+
+    df = (
+        df.join(pl.concat([by_asof, by_range]), on="_ROW", how="left")
+        .with_columns(
+            pl.coalesce(pl.col("EVTID"), pl.col("_STAYID")).alias("EVTID"),
+            pl.col("_STAYID").is_not_null().alias("_INTERVALLE")
+        )
+        .join(
+            df_stays.select(
+                pl.col("_STAYID").alias("EVTID"), "SEJUM", "SEJUF",
+                pl.lit(True).alias("_CONNU")
+            ),
+            on="EVTID", how="left"
+        )
+        .with_columns(pl.col("_CONNU").fill_null(False))
+        .sort("_ROW")
+    )
+
+    # Taux de rattachement : seul un EVTID present dans MVT compte comme rattache
+    by_interval = pl.col("_INTERVALLE")
+    stats = {
+        "total": df.height,
+        "reference": df.filter(~by_interval & pl.col("_CONNU")).height,
+        "reference_inconnue": df.filter(pl.col("EVTID").is_not_null() & ~pl.col("_CONNU")).height,
+        "orphelins": n_orphans,
+        "intervalle": df.filter(by_interval).height,
+        "intervalle_sejour_ouvert": df.filter(by_interval & pl.col("_OUVERT")).height,
+        "jointure_intervalle": to_range.height
+    }
+    stats["rattaches"] = stats["reference"] + stats["intervalle"]
+
+    df = df.drop(["_ROW", "_DEBUT", "_FIN_EVT", "_STAYID", "_OUVERT", "_INTERVALLE", "_CONNU"])
+    return df, stats
+
+def print_link_stats(name, stats):
+    """Affiche les taux de rattachement d'une table aux sejours"""
+    print(
+        f"Rattachement {name}: "
+        f"{stats['reference']} par reference "
+        f"({stats['reference_inconnue']} references absentes de MVT), "
+        f"{stats['intervalle']}/{stats['orphelins']} orphelins par intervalle "
+        f"({100 * stats['intervalle'] / max(stats['orphelins'], 1):.1f}%, "
+        f"dont {stats['intervalle_sejour_ouvert']} sur sejour sans DATSORT), "
+        f"taux global {100 * stats['rattaches'] / max(stats['total'], 1):.1f}%"
+    )
 
 # =====================================================
 # 4. EXPORT ET SAUVEGARDE
 # =====================================================
 
-if not PATIENT_rows: exit("Erreur: Pas de patients.")
-
-df_pat = pl.DataFrame(PATIENT_rows)
-df_pat.write_parquet(EDS_PATH + "patient.parquet")
-
-def save(rows, name, date_col):
-    """Sauvegarde une table en calculant l'age du patient"""
+def save(rows, name, date_col, df_pat, df_stays=None):
+    """
+    Sauvegarde une table en calculant l'age du patient.
+    Si df_stays est fourni, les evenements sont d'abord rattaches aux sejours.
+    """
     if not rows: return
     
+    df = pl.DataFrame(rows)
+
+    # Rattachement aux sejours (EVTID, SEJUM, SEJUF)
+    if df_stays is not None:
+        df, stats = link_to_stays(df, df_stays, date_col)
+        print_link_stats(name, stats)
+    
     # Jointure avec le patient pour avoir la date de naissance (PATBD)
-    df = pl.DataFrame(rows).join(df_pat, on="PATID", how="left")
+    df = df.join(df_pat, on="PATID", how="left")
     
     if date_col:
         # Calcul vectorise de l'age via list comprehension
@@ -213,9 +257,153 @@ def save(rows, name, date_col):
     df.write_parquet(EDS_PATH + name)
     print(f"Fichier genere: {name} ({len(df)} lignes)")
 
-# Generation des fichiers finaux
-save(MVT_rows, "mvt.parquet", "DATENT")
-save(BIOL_rows, "biol.parquet", "PRLVTDATE")
-save(PHARMA_rows, "pharma.parquet", "DATPRES")
-save(PMSI_rows, "pmsi.parquet", "DATENT")
-save(DOCEDS_rows, "doceds.parquet", "RECDATE")
\ No newline at end of file
+# =====================================================
+# 5. LECTURE, EXTRACTION ET GENERATION DES TABLES
+# =====================================================
+
+def fhir_to_edsan():
+    os.makedirs(EDS_PATH, exist_ok=True)
+
+    # Listes pour stocker les donnees avant conversion en DataFrame
+    PATIENT_rows = []
+    MVT_rows = []
+    BIOL_rows = []
+    PHARMA_rows = []
+    PMSI_rows = []
+    DOCEDS_rows = []
+
+    # Dictionnaire pour les jointures rapides (lookup)
+    # Les sejours (EVTID, SEJUM, SEJUF) sont rattaches apres coup par jointure
+    # sur les tables completes (voir link_to_stays).
+    MEDICATION_DICT = {}
+
+    files = glob.glob(FHIR_PATH)
+    print(f"Traitement de {len(files)} fichiers...")
+
+    for file in files:
+        with open(file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    
+        if "entry" not in data: continue
+
+        # PASSE 1 : Construction du dictionnaire des medicaments
+        for entry in data["entry"]:
+            r = entry.get("resource", {})
+            if r.get("resourceType") == "Medication":
+                code = safe_get(r, "code", "coding", 0, "code")
+                name = safe_get(r, "code", "coding", 0, "display")
+                MEDICATION_DICT[clean_id(r.get("id"))] = {"code": code, "name": name}
+
+        # PASSE 2 : Extraction des ressources cliniques
+        for entry in data["entry"]:
+            r = entry.get("resource", {})
+            rtype = r.get("resourceType")
+            rid = clean_id(r.get("id"))
+        
+            # Recuperation de l'ID patient nettoye
+            pat_ref = clean_id(safe_get(r, "subject", "reference") or safe_get(r, "patient", "reference"))
+
+            # --- Table PATIENT ---
+            if rtype == "Patient":
+                PATIENT_rows.append({
+                    "PATID": rid, 
+                    "PATSEX": r.get("gender"),
+                    "PATBD": r.get("birthDate")
+                })
+
+            # --- Table MVT (Rencontres/Sejours) ---
+            elif rtype == "Encounter":
+                sejum = safe_get(r, "location", 0, "physicalType", "text")
+                sejuf = clean_id(safe_get(r, "location", 0, "location", "reference"))
+            
+                MVT_rows.append({
+                    "PATID": pat_ref, 
+                    "EVTID": rid, 
+                    "ELTID": rid,
+                    "DATENT": safe_get(r, "period", "start"), 
+                    "DATSORT": safe_get(r, "period", "end"),
+                    "SEJUM": sejum,
+                    "SEJUF": sejuf
+                })
+
+            # --- Table BIOL (Resultats Labo) ---
+            elif rtype == "Observation" and "valueQuantity" in r:
+                evt_ref = clean_id(safe_get(r, "encounter", "reference"))
+                BIOL_rows.append({
+                    "PATID": pat_ref, 
+                    "EVTID": evt_ref, 
+                    "ELTID": rid,
+                    "PRLVTDATE": extract_date(r, "effectiveDateTime", "issued"),
+                    "PNAME": safe_get(r, "code", "text"),
+                    "RESULT": r["valueQuantity"].get("value"),
+                    "UNIT": r["valueQuantity"].get("unit")
+                })
+
+            # --- Table PHARMA (Prescriptions) ---
+            elif rtype == "MedicationRequest":
+                med_ref = clean_id(safe_get(r, "medicationReference", "reference"))
+                med_info = MEDICATION_DICT.get(med_ref, {})
+                name = med_info.get("name") or safe_get(r, "medicationCodeableConcept", "text")
+            
+                PHARMA_rows.append({
+                    "PATID": pat_ref, 
+                    "EVTID": clean_id(safe_get(r, "encounter", "reference")),
+                    "ELTID": rid, 
+                    "ALLSPELABEL": name, 
+                    "DATPRES": r.get("authoredOn"),
+                    "PRES": safe_get(r, "dosageInstruction", 0, "text")
+                })
+
+            # --- Table PMSI (Diagnostics et Actes) ---
+            elif rtype in ["Condition", "Procedure"]:
+                PMSI_rows.append({
+                    "PATID": pat_ref, 
+                    "EVTID": clean_id(safe_get(r, "encounter", "reference")),
+                    "ELTID": rid, 
+                    "TYPE": rtype,
+                    "CODE": safe_get(r, "code", "coding", 0, "code"),
+                    "LIBELLE": safe_get(r, "code", "text") or safe_get(r, "code", "coding", 0, "display"),
+                    "DATENT": extract_date(r, "onsetDateTime", "performedDateTime", "recordedDate")
+                })
+
+            # --- Table DOCEDS (Documents textuels) ---
+            elif rtype in ["DiagnosticReport", "DocumentReference"]:
+                evt_ref = clean_id(safe_get(r, "encounter", "reference"))
+                txt = "Non extrait"
+            
+                if rtype == "DiagnosticReport": 
+                    txt = safe_get(r, "presentedForm", 0, "data")
+                elif rtype == "DocumentReference": 
+                    txt = safe_get(r, "content", 0, "attachment", "data")
+
+                DOCEDS_rows.append({
+                    "PATID": pat_ref, 
+                    "EVTID": evt_ref, 
+                    "ELTID": rid,
+                    "RECTXT": txt, 
+                    "RECDATE": extract_date(r, "effectiveDateTime", "date", "created")
+                })
+
+    if not PATIENT_rows:
+        print("Erreur: Pas de patients.", file=sys.stderr)
+        return 1
+
+    df_pat = pl.DataFrame(PATIENT_rows)
+    df_pat.write_parquet(EDS_PATH + "patient.parquet")
+
+    df_mvt = pl.DataFrame(MVT_rows) if MVT_rows else pl.DataFrame(
+        schema={"PATID": pl.Utf8, "EVTID": pl.Utf8, "DATENT": pl.Utf8,
+                "DATSORT": pl.Utf8, "SEJUM": pl.Utf8, "SEJUF": pl.Utf8}
+    )
+    df_stays = prepare_stays(df_mvt)
+
+    # Generation des fichiers finaux
+    save(MVT_rows, "mvt.parquet", "DATENT", df_pat)
+    save(BIOL_rows, "biol.parquet", "PRLVTDATE", df_pat, df_stays)
+    save(PHARMA_rows, "pharma.parquet", "DATPRES", df_pat, df_stays)
+    save(PMSI_rows, "pmsi.parquet", "DATENT", df_pat, df_stays)
+    save(DOCEDS_rows, "doceds.parquet", "RECDATE", df_pat, df_stays)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(fhir_to_edsan())
\ No newline at end of file
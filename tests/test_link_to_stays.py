@@ -0,0 +1,139 @@
+import polars as pl
+
+from app.core.converters.fhir_to_edsan import link_to_stays, prepare_stays
+
+# =============================================================================
+# DONNEES DE TEST
+# =============================================================================
+
+MVT_SCHEMA = {"PATID": pl.Utf8, "EVTID": pl.Utf8, "DATENT": pl.Utf8,
+              "DATSORT": pl.Utf8, "SEJUM": pl.Utf8, "SEJUF": pl.Utf8}
+
+def make_stays():
+    """
+    Table MVT minimale pour le patient p1 :
+    - e1 : sejour du 01/01/2020 10h au 03/01/2020 10h
+    - e2 : sejour sans DATSORT (period.end absent) le 01/02/2020
+    - e3 : long sejour de mars 2020, qui contient le court sejour e4
+    """
+    df_mvt = pl.DataFrame({
+        "PATID": ["p1", "p1", "p1", "p1"],
+        "EVTID": ["e1", "e2", "e3", "e4"],
+        "DATENT": ["2020-01-01T10:00:00+01:00", "2020-02-01T10:00:00+01:00",
+                   "2020-03-01T08:00:00+01:00", "2020-03-05T08:00:00+01:00"],
+        "DATSORT": ["2020-01-03T10:00:00+01:00", None,
+                    "2020-03-20T08:00:00+01:00", "2020-03-06T08:00:00+01:00"],
+        "SEJUM": ["Cardio", "Urgences", "Medecine", "Bloc"],
+        "SEJUF": ["UF1", "UF2", "UF3", "UF4"]
+    })
+    return prepare_stays(df_mvt)
+
+def link(rows, df_stays=None):
+    """
+    Rattache des lignes BIOL et retourne (EVTID par ELTID, table rattachee,
+    statistiques).
+    """
+    if df_stays is None:
+        df_stays = make_stays()
+    df, stats = link_to_stays(pl.DataFrame(rows), df_stays, "PRLVTDATE")
+    return dict(zip(df["ELTID"], df["EVTID"])), df, stats
+
+def biol(eltid, date, evtid=None, patid="p1"):
+    return {"PATID": patid, "EVTID": evtid, "ELTID": eltid, "PRLVTDATE": date}
+
+# =============================================================================
+# TESTS
+# =============================================================================
+
+def test_reference_conservee():
+    # Une reference explicite est gardee, meme hors des dates du sejour
+    evt, df, stats = link([biol("o1", "2022-01-05", evtid="e1")])
+    assert evt["o1"] == "e1"
+    assert df["SEJUM"].to_list() == ["Cardio"]
+    assert stats["reference"] == 1 and stats["rattaches"] == 1
+
+def test_orphelin_dans_sejour():
+    evt, df, stats = link([biol("o1", "2020-01-02T08:00:00+01:00")])
+    assert evt["o1"] == "e1"
+    assert df["SEJUF"].to_list() == ["UF1"]
+    assert stats["intervalle"] == 1 and stats["orphelins"] == 1
+
+def test_orphelin_apres_datsort():
+    # Le sejour trouve par asof (e1) est termine et aucun autre ne couvre
+    # l'evenement : il ne passe pas par la jointure d'intervalle
+    evt, _, stats = link([biol("o1", "2020-01-05T11:00:00+01:00")])
+    assert evt["o1"] is None
+    assert stats["intervalle"] == 0 and stats["rattaches"] == 0
+    assert stats["jointure_intervalle"] == 0
+
+def test_orphelin_avant_tout_sejour():
+    evt, _, stats = link([biol("o1", "2019-06-01T10:00:00+01:00")])
+    assert evt["o1"] is None
+    assert stats["jointure_intervalle"] == 0
+
+def test_sejour_sans_datsort_borne():
+    # Un sejour sans period.end ne capte pas un evenement bien plus tardif
+    evt, _, stats = link([
+        biol("o1", "2020-02-01T15:00:00+01:00"),
+        biol("o2", "2021-01-01T10:00:00+01:00")
+    ])
+    assert evt["o1"] == "e2"
+    assert evt["o2"] is None
+    assert stats["intervalle_sejour_ouvert"] == 1
+
+def test_sejours_imbriques():
+    # e4 (le plus recent) est termine, mais e3 couvre encore la date
+    evt, _, stats = link([
+        biol("o1", "2020-03-05T12:00:00+01:00"),
+        biol("o2", "2020-03-10T12:00:00+01:00"),
+        biol("o3", "2020-03-25T12:00:00+01:00")
+    ])
+    assert evt["o1"] == "e4"
+    assert evt["o2"] == "e3"
+    assert evt["o3"] is None
+    # Seul o2 est couvert par un sejour plus ancien que celui trouve par asof
+    assert stats["jointure_intervalle"] == 1
+
+def test_decalages_horaires_differents():
+    # 09:30Z = 10:30+01:00, donc apres le debut de e1 (10:00+01:00)
+    evt, _, _ = link([
+        biol("o1", "2020-01-01T09:30:00Z"),
+        biol("o2", "2020-01-01T08:30:00Z"),
+        biol("o3", "2020-01-03T04:30:00.250-05:00")
+    ])
+    assert evt["o1"] == "e1"
+    assert evt["o2"] is None
+    # 04:30-05:00 = 10:30+01:00, apres la fin de e1 (10:00+01:00)
+    assert evt["o3"] is None
+
+def test_table_mvt_vide():
+    df_stays = prepare_stays(pl.DataFrame(schema=MVT_SCHEMA))
+    evt, df, stats = link([
+        biol("o1", "2020-01-02T08:00:00+01:00"),
+        biol("o2", "2020-01-02", evtid="e1")
+    ], df_stays)
+    assert evt == {"o1": None, "o2": "e1"}
+    assert df["SEJUM"].to_list() == [None, None]
+    assert stats["rattaches"] == 0 and stats["reference_inconnue"] == 1
+
+def test_reference_inconnue():
+    evt, df, stats = link([biol("o1", "2020-01-02", evtid="zz")])
+    assert evt["o1"] == "zz"
+    assert df["SEJUM"].to_list() == [None]
+    assert stats["reference"] == 0
+    assert stats["reference_inconnue"] == 1
+    assert stats["rattaches"] == 0
+
+def test_date_sans_heure():
+    # Le sejour e1 commence a 10h le jour meme : comparaison a la journee
+    evt, _, _ = link([
+        biol("o1", "2020-01-01"),
+        biol("o2", "2020-01-03")
+    ])
+    assert evt["o1"] == "e1"
+    assert evt["o2"] == "e1"
+
+def test_sans_patid():
+    evt, _, stats = link([biol("o1", "2020-01-02T08:00:00+01:00", patid=None)])
+    assert evt["o1"] is None
+    assert stats["orphelins"] == 1 and stats["rattaches"] == 0